@@ -1,11 +1,16 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import plotly.graph_objects as go
-from datetime import datetime, timedelta
-import random
+from datetime import date
+import glob
+import hashlib
+import os
+import tempfile
 
 # Importiamo la logica dal core
-from price_tracker_core import ProductRanking, PriceIntelligenceEngine, get_gsheet_data
+import price_tracker_core
+from price_tracker_core import PriceIntelligenceEngine, download_gsheet_csv, get_gsheet_data, parse_products, random_walk
 
 # ==============================================================================
 # CONFIGURAZIONE PAGINA
@@ -37,144 +42,255 @@ st.markdown("""
 # DATI & LOGICA
 # ==============================================================================
 
-def generate_history(base_price, variance=0.05):
-    """Genera serie storica realistica per il grafico"""
-    dates = [datetime.now() - timedelta(days=i) for i in range(30, -1, -1)]
-    prices = []
-    current = base_price
-    for _ in range(31):
-        change = random.uniform(-variance, variance)
-        current = max(base_price * 0.7, current * (1 + change))
-        prices.append(round(current, 2))
-    return dates, prices
-
-@st.cache_data
+HISTORY_DAYS = 31
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache")
+_rng = np.random.default_rng()
+
+def history_dates():
+    """Date dello storico (ultimi 30 giorni + oggi), uguali per tutte le serie"""
+    return pd.date_range(end=pd.Timestamp.now().normalize(), periods=HISTORY_DAYS, freq="D")
+
+def generate_histories(base_prices, variances):
+    """Genera in un'unica chiamata le serie storiche realistiche per il grafico (una riga per serie)"""
+    # float32: precisione al centesimo più che sufficiente, 1/7 della memoria di una lista di float
+    return np.round(random_walk(base_prices, variances, HISTORY_DAYS, _rng), 2).astype(np.float32)
+
+@st.cache_data(ttl=3600, max_entries=256)
+def get_price_history(product_id, my_price, merchants, prices):
+    """Storico prezzi simulato di un prodotto, generato solo quando viene visualizzato"""
+    # Noi + competitor in un solo blocco
+    competitors = [(merchant, price) for merchant, price in zip(merchants, prices) if merchant != "Sensation Shop"]
+    series = generate_histories(
+        [my_price] + [price for _, price in competitors],
+        [0.01] + [0.03] * len(competitors)
+    )
+    history = {"Sensation Shop (Noi)": series[0]}
+    for (merchant, _), merchant_prices in zip(competitors, series[1:]):
+        history[merchant] = merchant_prices
+    return history_dates(), history
+
+@st.cache_data(ttl=3600)
 def load_data_gfk_style():
     """Trasforma i dati grezzi del GSheet in oggetti pronti per la UI"""
-    raw_data = get_gsheet_data() 
+    content = download_gsheet_csv()
+    if content is None:
+        return pd.DataFrame()
+
+    # Cache su disco: se il CSV scaricato, questo file e il core non sono cambiati (e siamo nello
+    # stesso giorno, così i valori simulati vengono estratti di nuovo una volta al giorno) evitiamo
+    # tutta l'elaborazione. La chiave usa il CSV grezzo, prima che get_gsheet_data aggiunga i valori simulati
+    source = b""
+    for path in (__file__, price_tracker_core.__file__):
+        with open(path, "rb") as f:
+            source += f.read()
+    key = hashlib.sha1(source + str(date.today()).encode() + content).hexdigest()[:16]
+    cache_path = os.path.join(CACHE_DIR, f"ui_{key}.pkl")
+    try:
+        return pd.read_pickle(cache_path)
+    except Exception:
+        # Snapshot assente, troncato o illeggibile (es. pickle di un'altra versione di pandas): lo ricostruiamo
+        pass
+
+    raw_data = get_gsheet_data(content)
     if not raw_data:
         return pd.DataFrame()
 
-    # Arricchimento dati tramite l'engine
-    products = [ProductRanking(**item) for item in raw_data]
+    # Arricchimento dati tramite l'engine (i record del GSheet sono già tipizzati da noi)
+    products = parse_products(raw_data, strict=False)
     analyzed_products = PriceIntelligenceEngine.enrich_data(products)
     
-    ui_data = []
-    for p in analyzed_products:
-        # Generiamo dati tecnici simulati se mancanti (MPN/EAN)
-        mpn = f"{p.brand[:3].upper()}-{random.randint(100,999)}"
-        ean = f"{random.randint(1000000000000, 9999999999999)}"
-        my_stock = "Out of stock" if random.random() > 0.8 else "In stock"
-        
-        # Generazione Storico Prezzi
-        history = {}
-        dates, prices_me = generate_history(p.total_cost, 0.01)
-        history["Sensation Shop (Noi)"] = prices_me
-        
-        for offer in p.best_offers:
-            if offer.merchant != "Sensation Shop":
-                _, prices_comp = generate_history(offer.price, 0.03)
-                history[offer.merchant] = prices_comp
-            
-        ui_data.append({
-            "object": p,
-            "id": p.sku,
-            "brand": p.brand,
-            "product_name": p.product_name,
-            "mpn": mpn,
-            "ean": ean,
-            "my_price": p.total_cost,
-            "my_stock": my_stock,
-            "category": p.category,
-            "image": p.image_url,
-            "history_dates": dates,
-            "history_prices": history
-        })
-    return pd.DataFrame(ui_data)
+    n = len(analyzed_products)
+    # Dati tecnici simulati se mancanti (MPN/EAN) e aggiornamento simulato delle offerte,
+    # estratti in blocco (in cache) e non a ogni rerun
+    mpn_codes = _rng.integers(100, 1000, size=n)
+    eans = _rng.integers(10**12, 10**13, size=n).astype(str)
+    offer_counts = [len(p.best_offers) for p in analyzed_products]
+    minutes_ago = np.split(_rng.integers(5, 60, size=sum(offer_counts)), np.cumsum(offer_counts)[:-1])
+    
+    # Costruzione per colonne: evita una dict per prodotto
+    ui_data = {
+        "id": [p.sku for p in analyzed_products],
+        "brand": [p.brand for p in analyzed_products],
+        "product_name": [p.product_name for p in analyzed_products],
+        "mpn": [f"{p.brand[:3].upper()}-{code}" for p, code in zip(analyzed_products, mpn_codes)],
+        "ean": eans,
+        "my_price": np.fromiter((p.total_cost for p in analyzed_products), dtype=np.float64, count=n),
+        "price_gap": np.fromiter((p.price_gap for p in analyzed_products), dtype=np.float64, count=n),
+        "category": [p.category for p in analyzed_products],
+        "image": [p.image_url for p in analyzed_products],
+        "offer_merchants": [[offer.merchant for offer in p.best_offers] for p in analyzed_products],
+        "offer_prices": [[offer.price for offer in p.best_offers] for p in analyzed_products],
+        "offer_updated": [[f"{m}m ago" for m in product_minutes] for product_minutes in minutes_ago]
+    }
+    # Indicizzato per ID (il dataset Kaggle ripete lo stesso prodotto su più righe:
+    # teniamo la prima, come faceva la ricerca per maschera)
+    df = pd.DataFrame(ui_data).drop_duplicates("id").set_index("id", drop=False).rename_axis(None)
+    # Disponibilità simulata: una sola estrazione per tutto il catalogo
+    df["my_stock"] = np.where(_rng.random(len(df)) > 0.8, "Out of stock", "In stock")
+    # Etichetta per la barra di ricerca, calcolata una volta sola in modo vettoriale
+    df["search_label"] = df["brand"] + " - " + df["product_name"] + " (ID: " + df["id"] + ")"
+    # Colonne dei filtri in sidebar come categorie: isin lavora sui codici interi.
+    # Prezzi in float32: la precisione al centesimo è ampiamente coperta
+    df = df.astype({"brand": "category", "category": "category", "my_stock": "category", "my_price": "float32"})
+    # Versione dei dati: cache_data restituisce ogni volta una copia, quindi id(df) non è stabile
+    df.attrs["version"] = key
+    
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        for stale in glob.glob(os.path.join(CACHE_DIR, "ui_*.pkl")):
+            try:
+                os.remove(stale)
+            except OSError:
+                pass  # già rimosso da un'altra sessione
+        # Scrittura su file temporaneo + os.replace: mai uno snapshot a metà sotto il nome definitivo
+        fd, tmp_path = tempfile.mkstemp(dir=CACHE_DIR, suffix=".tmp")
+        os.close(fd)
+        try:
+            df.to_pickle(tmp_path)
+            os.replace(tmp_path, cache_path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+    except OSError:
+        pass  # disco pieno o cartella non scrivibile: la cache su disco è solo un'ottimizzazione
+    return df
+
+def category_mask(column, selected):
+    """Equivalente di column.isin(selected) per colonne categoriche, calcolato sui codici interi"""
+    codes = column.cat.categories.get_indexer(selected)
+    # Un posto in più in fondo: il codice -1 (valore mancante) non è mai selezionato
+    valid = np.zeros(len(column.cat.categories) + 1, dtype=bool)
+    valid[codes[codes >= 0]] = True
+    return valid[column.cat.codes.to_numpy()]
 
 # ==============================================================================
 # UI COMPONENTS
 # ==============================================================================
 
-def render_left_panel(row):
-    """Visualizza i dettagli del prodotto selezionato a sinistra"""
-    # Se l'URL immagine è vuoto, usa un placeholder
-    img_url = row['image'] if row['image'] and str(row['image']) != 'nan' else "https://via.placeholder.com/300?text=No+Image"
-    
-    html_content = f"""
+# Parte statica del pannello prodotto: costruita una volta, a ogni rerun si riempiono solo i campi
+LEFT_PANEL_HTML = """
     <div class="product-panel">
         <div style="text-align: center; margin-bottom: 20px;">
             <img src="{img_url}" style="border-radius: 4px; max-width: 100%; height: auto; max-height: 250px;">
         </div>
         <div class="panel-label">ID / ASIN</div>
-        <div class="panel-value" style="color: #3b82f6;">{row['id']}</div>
+        <div class="panel-value" style="color: #3b82f6;">{id}</div>
         <div class="panel-label">Brand</div>
-        <div class="panel-value">{row['brand']}</div>
+        <div class="panel-value">{brand}</div>
         <div class="panel-label">MPN</div>
-        <div class="panel-value">{row['mpn']}</div>
+        <div class="panel-value">{mpn}</div>
         <div class="panel-label">Price</div>
-        <div class="panel-value-price">€ {row['my_price']:.2f}</div>
+        <div class="panel-value-price">€ {my_price:.2f}</div>
         <div class="panel-label">Stock</div>
         <div style="margin-top: 5px;">
-            <span class="{'stock-in' if row['my_stock'] == 'In stock' else 'stock-out'}">{row['my_stock']}</span>
+            <span class="{stock_class}">{my_stock}</span>
         </div>
         <div class="panel-label">Category</div>
-        <div style="background: #f3f4f6; padding: 4px 8px; font-size: 12px; border-radius: 4px; display: inline-block;">{row['category']}</div>
+        <div style="background: #f3f4f6; padding: 4px 8px; font-size: 12px; border-radius: 4px; display: inline-block;">{category}</div>
     </div>
     """
-    st.markdown(html_content, unsafe_allow_html=True)
 
-def render_chart(row):
-    """Grafico delle variazioni di prezzo dei competitor"""
-    dates = row['history_dates']
-    history = row['history_prices']
-    fig = go.Figure()
-    colors = ['#1e40af', '#f97316', '#dc2626', '#16a34a', '#9333ea']
+def render_left_panel(row):
+    """Visualizza i dettagli del prodotto selezionato a sinistra"""
+    # Se l'URL immagine è vuoto, usa un placeholder
+    img_url = row['image'] if row['image'] and str(row['image']) != 'nan' else "https://via.placeholder.com/300?text=No+Image"
     
-    for i, (merchant, prices) in enumerate(history.items()):
+    # Semplice riempimento del template: è già molto più veloce di un lookup in st.cache_data
+    html_content = LEFT_PANEL_HTML.format(
+        img_url=img_url, id=row['id'], brand=row['brand'], mpn=row['mpn'],
+        my_price=row['my_price'], my_stock=row['my_stock'], category=row['category'],
+        stock_class='stock-in' if row['my_stock'] == 'In stock' else 'stock-out'
+    )
+    st.markdown(html_content, unsafe_allow_html=True)
+
+MAX_CHART_POINTS = 400
+
+def lttb_indices(prices, n_out=MAX_CHART_POINTS):
+    """Indici dei punti da tenere (Largest-Triangle-Three-Buckets) per una serie a passo giornaliero"""
+    n = len(prices)
+    if n <= n_out or n_out < 3:
+        return np.arange(n)
+    y = np.asarray(prices, dtype=float)
+    x = np.arange(n, dtype=float)
+    every = (n - 2) / (n_out - 2)
+    idx = np.empty(n_out, dtype=int)
+    idx[0], idx[-1] = 0, n - 1
+    a = 0
+    for i in range(n_out - 2):
+        # Media del bucket successivo come terzo vertice del triangolo
+        nxt_start = int((i + 1) * every) + 1
+        nxt_end = min(int((i + 2) * every) + 1, n)
+        avg_x, avg_y = x[nxt_start:nxt_end].mean(), y[nxt_start:nxt_end].mean()
+        start, end = int(i * every) + 1, int((i + 1) * every) + 1
+        area = np.abs((x[a] - avg_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (avg_y - y[a]))
+        a = start + int(area.argmax())
+        idx[i + 1] = a
+    return idx
+
+# Stili e layout del grafico storico (letti solo da build_price_figure, che è in cache: il risparmio viene da lì)
+CHART_COLORS = ['#1e40af', '#f97316', '#dc2626', '#16a34a', '#9333ea']
+ME_TRACE_STYLE = dict(mode='lines+markers', line_width=2.5, line_dash='solid', marker_size=6)
+OTHER_TRACE_STYLE = dict(mode='lines+markers', line_width=1.5, line_dash='dash', marker_size=6)
+CHART_LAYOUT = dict(
+    height=380, margin=dict(l=0, r=0, t=30, b=0),
+    plot_bgcolor='white', paper_bgcolor='rgba(0,0,0,0)',
+    xaxis=dict(showgrid=True, gridcolor='#f3f4f6'),
+    yaxis=dict(showgrid=True, gridcolor='#f3f4f6', title="Prezzo (€)", hoverformat=".2f"),
+    legend=dict(orientation="h", yanchor="bottom", y=1.02, xanchor="right", x=1)
+)
+
+@st.cache_resource(max_entries=128)
+def build_price_figure(product_id, dates, history):
+    """Costruisce (una volta per prodotto) la figura Plotly dello storico prezzi"""
+    traces = []
+    for i, (merchant, prices) in enumerate(history):
         is_me = "Noi" in merchant
-        fig.add_trace(go.Scatter(
-            x=dates, y=prices, mode='lines+markers', name=merchant,
-            line=dict(color=colors[i % len(colors)], width=2.5 if is_me else 1.5, dash='solid' if is_me else 'dash'),
-            marker=dict(size=6)
+        # Con storici lunghi inviamo al browser solo i punti visivamente rilevanti
+        x, y = dates, prices
+        if len(prices) > MAX_CHART_POINTS:
+            keep = lttb_indices(prices)
+            x, y = dates[keep], prices[keep]
+        traces.append(go.Scattergl(
+            x=x, y=y, name=merchant, line_color=CHART_COLORS[i % len(CHART_COLORS)],
+            **(ME_TRACE_STYLE if is_me else OTHER_TRACE_STYLE)
         ))
+    # Figura costruita in un colpo solo: una validazione invece di add_trace + update_layout
+    return go.Figure(data=traces, layout=CHART_LAYOUT)
 
-    fig.update_layout(
-        height=380, margin=dict(l=0, r=0, t=30, b=0),
-        plot_bgcolor='white', paper_bgcolor='rgba(0,0,0,0)',
-        xaxis=dict(showgrid=True, gridcolor='#f3f4f6'),
-        yaxis=dict(showgrid=True, gridcolor='#f3f4f6', title="Prezzo (€)"),
-        legend=dict(orientation="h", yanchor="bottom", y=1.02, xanchor="right", x=1)
+def render_chart(row):
+    """Grafico delle variazioni di prezzo dei competitor"""
+    dates, history = get_price_history(
+        row['id'], row['my_price'], tuple(row['offer_merchants']), tuple(row['offer_prices'])
     )
+    # Argomenti hashable: la figura viene riusata nei rerun senza cambio di selezione
+    fig = build_price_figure(row['id'], dates.values, tuple(history.items()))
     st.plotly_chart(fig, use_container_width=True)
 
 def render_table(row):
     """Tabella di confronto prezzi istantanea"""
-    p_obj = row['object']
-    table_data = []
+    my_price = round(float(row['my_price']), 2)  # da float32, per non mostrare il rumore di rappresentazione
     
-    # Aggiungi dato "Noi"
-    table_data.append({
-        "Web": "🔵 Sensation Shop",
-        "Price": f"€ {row['my_price']:.2f}",
-        "Diff %": "-",
-        "Stock": row['my_stock'],
-        "Last Update": "Just now"
-    })
+    # Competitor reali dal modello, elaborati per colonne
+    competitors = [offer for offer in zip(row['offer_merchants'], row['offer_prices'], row['offer_updated'])
+                   if offer[0] != "Sensation Shop"]
+    prices = np.fromiter((price for _, price, _ in competitors), dtype=np.float64, count=len(competitors))
+    diff_pct = (prices - my_price) / my_price * 100.0
     
-    # Aggiungi competitor reali dal modello
-    for offer in p_obj.best_offers:
-        if offer.merchant == "Sensation Shop": continue
-        diff_pct = ((offer.price - row['my_price']) / row['my_price']) * 100
-        table_data.append({
-            "Web": f"🔴 {offer.merchant}",
-            "Price": f"€ {offer.price:.2f}",
-            "Diff %": f"{diff_pct:+.1f}%",
-            "Stock": "In Stock",
-            "Last Update": f"{random.randint(5, 59)}m ago"
-        })
-        
-    st.dataframe(pd.DataFrame(table_data), use_container_width=True, hide_index=True)
+    # Prima riga: dato "Noi". Prezzi e differenze restano numerici, li formatta il frontend
+    table = pd.DataFrame({
+        "Web": ["🔵 Sensation Shop"] + [f"🔴 {merchant}" for merchant, _, _ in competitors],
+        "Price": np.concatenate(([my_price], prices)),
+        "Diff %": np.concatenate(([np.nan], diff_pct)),
+        "Stock": [row['my_stock']] + ["In Stock"] * len(competitors),
+        "Last Update": ["Just now"] + [updated for _, _, updated in competitors]
+    })
+    st.dataframe(
+        table, use_container_width=True, hide_index=True,
+        column_config={
+            "Price": st.column_config.NumberColumn(format="€ %.2f"),
+            "Diff %": st.column_config.NumberColumn(format="%+.1f%%")
+        }
+    )
 
 # ==============================================================================
 # MAIN APP EXECUTION
@@ -193,10 +309,11 @@ with st.sidebar:
     st.title("Hub Intelligence")
     st.divider()
     
-    brand_list = sorted(df['brand'].unique())
+    # Le categorie del dtype sono già i valori distinti, ordinati: niente scansione a ogni rerun
+    brand_list = df['brand'].cat.categories.tolist()
     selected_brand = st.multiselect("Filtra per Brand", brand_list, default=brand_list[:3] if len(brand_list)>3 else brand_list)
     
-    cat_list = sorted(df['category'].unique())
+    cat_list = df['category'].cat.categories.tolist()
     selected_cat = st.multiselect("Filtra per Categoria", cat_list, default=cat_list)
     
     if st.button("🔄 Aggiorna Dati GSheet", use_container_width=True):
@@ -204,19 +321,28 @@ with st.sidebar:
         st.rerun()
 
 # Applicazione filtri
-df_filtered = df[df['brand'].isin(selected_brand) & df['category'].isin(selected_cat)]
+df_filtered = df[category_mask(df['brand'], selected_brand) & category_mask(df['category'], selected_cat)]
 
 # Barra di ricerca superiore
 st.subheader("Analisi Comparativa Mercato")
-product_options = df_filtered.apply(lambda x: f"{x['brand']} - {x['product_name']} (ID: {x['id']})", axis=1).tolist()
+# Opzioni ricalcolate solo se cambiano dati o filtri, non a ogni interazione
+options_key = (df.attrs.get("version"), tuple(selected_brand), tuple(selected_cat))
+if st.session_state.get("product_options_key") != options_key:
+    st.session_state.product_options = df_filtered['id'].tolist()
+    st.session_state.product_labels = dict(zip(df_filtered['id'], df_filtered['search_label']))
+    st.session_state.product_options_key = options_key
+product_options = st.session_state.product_options
 
 if not product_options:
     st.error("Nessun prodotto corrisponde ai filtri selezionati.")
     st.stop()
 
-selected_option = st.selectbox("Cerca Prodotto nel Dataset...", product_options)
-selected_id = selected_option.split("(ID: ")[1].replace(")", "")
-current_row = df_filtered[df_filtered['id'] == selected_id].iloc[0]
+# Le opzioni sono gli ID: nessun parsing dell'etichetta mostrata
+selected_id = st.selectbox(
+    "Cerca Prodotto nel Dataset...", product_options,
+    format_func=st.session_state.product_labels.__getitem__
+)
+current_row = df_filtered.loc[selected_id]
 
 st.divider()
 
@@ -235,7 +361,7 @@ with col_main:
 
     # Note di Intelligence
     with st.expander("💡 Suggerimento Strategico"):
-        gap = current_row['object'].price_gap
+        gap = current_row['price_gap']
         if gap > 0:
             st.info(f"Sei più caro della media di mercato di €{gap}. Considera un ribasso del 2% per aumentare la conversione.")
         else:
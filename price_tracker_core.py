@@ -1,13 +1,24 @@
+import io
 import os
-import requests
 import logging
 import csv
-import pandas as pd
-import random
+import tempfile
+import numpy as np
 from datetime import datetime
-from typing import List, Optional, Dict, Any
+from functools import lru_cache
+from typing import TYPE_CHECKING, List, Optional, Dict, Any
 from pydantic import BaseModel, Field, field_validator
 
+try:
+    from numba import njit
+except ImportError:  # Numba è opzionale: senza, lo storico usa il percorso NumPy
+    njit = None
+
+# pandas e requests servono solo per il download del GSheet: importati al primo uso
+if TYPE_CHECKING:
+    import pandas as pd
+    import requests
+
 # Configurazione Logging
 logging.basicConfig(
     level=logging.INFO,
@@ -16,6 +27,20 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+@lru_cache(maxsize=None)
+def _http_session() -> "requests.Session":
+    """Sessione HTTP condivisa: riusa la connessione TLS tra un download e l'altro."""
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(
+        pool_connections=4, pool_maxsize=4,
+        max_retries=Retry(total=2, backoff_factor=0.2, status_forcelist=[502, 503, 504])
+    ))
+    return session
+
 # ==============================================================================
 # 1. MODELLI DATI (Pydantic)
 # ==============================================================================
@@ -53,6 +78,16 @@ class ProductRanking(BaseModel):
     def parse_best_offers(cls, v):
         return v if v is not None else []
 
+def parse_products(raw_data: List[Dict[str, Any]], strict: bool = True) -> List[ProductRanking]:
+    """Converte i record grezzi in ProductRanking (strict=False salta la validazione, solo per dati già tipizzati)."""
+    if strict:
+        return [ProductRanking(**item) for item in raw_data]
+    products = []
+    for item in raw_data:
+        offers = [BestOffer.model_construct(**offer) for offer in item.get("BestOffers") or []]
+        products.append(ProductRanking.model_construct(**{**item, "BestOffers": offers}))
+    return products
+
 # ==============================================================================
 # 2. ANALYTICS ENGINE
 # ==============================================================================
@@ -60,73 +95,203 @@ class ProductRanking(BaseModel):
 class PriceIntelligenceEngine:
     @staticmethod
     def enrich_data(products: List[ProductRanking]) -> List[ProductRanking]:
-        for p in products:
-            p.is_winning = (p.rank_with_shipping == 1)
-            gap = p.total_cost - p.min_price_shipping_market
-            p.price_gap = round(gap, 2)
+        # Calcolo per colonne, poi un solo passaggio per riassegnare i valori
+        n = len(products)
+        totals = np.fromiter((p.total_cost for p in products), dtype=np.float64, count=n)
+        min_prices = np.fromiter((p.min_price_shipping_market for p in products), dtype=np.float64, count=n)
+        ranks = np.fromiter((p.rank_with_shipping for p in products), dtype=np.int64, count=n)
+        gaps = np.round(totals - min_prices, 2).tolist()
+        winning = (ranks == 1).tolist()
+        for p, gap, is_winning in zip(products, gaps, winning):
+            p.is_winning = is_winning
+            p.price_gap = gap
         return products
 
+# Kernel dello storico simulato qui e non nello script Streamlit: il modulo è importato una
+# volta per processo, quindi il dispatcher Numba (e la sua compilazione) non si ricrea a ogni rerun
+def _random_walk_numpy(base_prices: np.ndarray, variances: np.ndarray, days: int, rng: np.random.Generator) -> np.ndarray:
+    """Random walk moltiplicativo per più serie: una riga per prezzo base"""
+    changes = rng.uniform(-variances[:, None], variances[:, None], size=(len(base_prices), days))
+    prices = base_prices[:, None] * np.cumprod(1 + changes, axis=1)
+    return np.maximum(prices, base_prices[:, None] * 0.7)
+
+if njit is not None:
+    @njit(cache=True)
+    def _random_walk_numba(base_prices, variances, days, seed):
+        np.random.seed(seed)
+        out = np.empty((base_prices.shape[0], days))
+        for s in range(base_prices.shape[0]):
+            current = base_prices[s]
+            for d in range(days):
+                current *= 1 + np.random.uniform(-variances[s], variances[s])
+                out[s, d] = max(current, base_prices[s] * 0.7)
+        return out
+
+def random_walk(base_prices, variances, days: int, rng: Optional[np.random.Generator] = None) -> np.ndarray:
+    """Storico simulato (n_serie x giorni), compilato con Numba se disponibile"""
+    rng = rng if rng is not None else np.random.default_rng()
+    base_prices = np.asarray(base_prices, dtype=np.float64)
+    variances = np.asarray(variances, dtype=np.float64)
+    if njit is not None:
+        return _random_walk_numba(base_prices, variances, days, int(rng.integers(2**31)))
+    return _random_walk_numpy(base_prices, variances, days, rng)
+
 # ==============================================================================
 # 3. GOOGLE SHEETS DATA FETCHING (Kaggle Format)
 # ==============================================================================
 
-def get_gsheet_data() -> List[Dict[str, Any]]:
-    """Legge i dati dal Google Sheet con i nomi colonne Kaggle."""
-    sheet_id = "1cnnxfowByYo6lwValEU_1YCT8ZQZO4mwSiwqeNx1wiA"
-    gid = "797884028"
-    url = f"https://docs.google.com/spreadsheets/d/{sheet_id}/export?format=csv&gid={gid}"
-    
+GSHEET_ID = "1cnnxfowByYo6lwValEU_1YCT8ZQZO4mwSiwqeNx1wiA"
+GSHEET_GID = "797884028"
+GSHEET_URL = f"https://docs.google.com/spreadsheets/d/{GSHEET_ID}/export?format=csv&gid={GSHEET_GID}"
+GSHEET_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "price_tracker")
+
+def _write_atomic(path: str, data: bytes) -> None:
+    """Scrive su un file temporaneo nella stessa cartella e lo sostituisce a path in un colpo solo."""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+def _download_csv(url: str) -> bytes:
+    """Scarica il CSV del GSheet con GET condizionale (ETag / Last-Modified), riusando la copia locale se invariato."""
+    csv_path = os.path.join(GSHEET_CACHE_DIR, "gsheet.csv")
+    meta_path = os.path.join(GSHEET_CACHE_DIR, "gsheet.etag")
+    headers = {}
+    try:
+        with open(meta_path, encoding="utf-8") as f:
+            etag, _, last_modified = f.read().partition("\n")
+    except OSError:
+        etag = last_modified = ""
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
+
+    response = _http_session().get(url, headers=headers, timeout=30)
+    if response.status_code == 304:
+        try:
+            with open(csv_path, "rb") as f:
+                logger.info("GSheet invariato, uso la copia locale")
+                return f.read()
+        except OSError:
+            # Copia locale mancante o illeggibile: riscarichiamo senza condizioni
+            response = _http_session().get(url, timeout=30)
+    response.raise_for_status()
+
+    etag = response.headers.get("ETag", "")
+    last_modified = response.headers.get("Last-Modified", "")
+    if etag or last_modified:
+        try:
+            # Prima il CSV e poi l'ETag: un crash a metà non lascia mai un ETag valido accanto a un CSV troncato
+            os.makedirs(GSHEET_CACHE_DIR, exist_ok=True)
+            _write_atomic(csv_path, response.content)
+            _write_atomic(meta_path, f"{etag}\n{last_modified}".encode("utf-8"))
+        except OSError as e:
+            logger.warning("Impossibile salvare la copia locale del GSheet: %s", e)
+    return response.content
+
+# Colonne del dataset Kaggle effettivamente usate: le altre non vengono nemmeno parsate
+SHEET_TEXT_COLUMNS = ['id', 'asins', 'brand', 'categories', 'name', 'imageURLs']
+SHEET_COLUMNS = set(SHEET_TEXT_COLUMNS) | {'prices.amountMax'}
+
+PLACEHOLDER_IMAGE_URL = "https://via.placeholder.com/300?text=Immagine+Non+Disponibile"
+
+def _text_column(df: "pd.DataFrame", column: str, default: str) -> "pd.Series":
+    """Colonna testuale del GSheet, con default se la colonna manca o la cella è vuota."""
+    import pandas as pd
+
+    if column not in df:
+        return pd.Series(default, index=df.index, dtype=object)
+    return df[column].astype(object).where(df[column].notna(), default).astype(str)
+
+def download_gsheet_csv() -> Optional[bytes]:
+    """Scarica il CSV grezzo del GSheet (None in caso di errore)."""
     try:
         logger.info("Connessione al dataset Kaggle su GSheet...")
-        df = pd.read_csv(url)
+        return _download_csv(GSHEET_URL)
+    except Exception as e:
+        logger.error("Errore GSheet: %s", e)
+        return None
+
+def get_gsheet_data(content: Optional[bytes] = None) -> List[Dict[str, Any]]:
+    """Legge i dati dal Google Sheet con i nomi colonne Kaggle (content: CSV già scaricato)."""
+    import pandas as pd
+
+    if content is None:
+        content = download_gsheet_csv()
+        if content is None:
+            return []
+    
+    try:
+        # Leggiamo prima l'intestazione: usecols e dtype vanno dati con i nomi reali (es. " id ")
+        header = pd.read_csv(io.BytesIO(content), nrows=0, engine='c').columns
+        df = pd.read_csv(
+            io.BytesIO(content),
+            usecols=[c for c in header if c.strip() in SHEET_COLUMNS],
+            dtype={c: 'string' for c in header if c.strip() in SHEET_TEXT_COLUMNS},
+            engine='c'
+        )
         df.columns = [c.strip() for c in df.columns]
         
-        products_list = []
-        for i, row in df.iterrows():
-            # Estrazione Prezzo
-            try:
-                price = float(row.get('prices.amountMax', 0))
-            except:
-                price = 0.0
-            
-            if price == 0 or pd.isna(price): 
-                continue
-
-            # Gestione Immagine (evita errori se la cella è vuota o NaN)
-            image_raw = row.get('imageURLs', '')
-            if pd.isna(image_raw) or image_raw == '':
-                image_url = "https://via.placeholder.com/300?text=Immagine+Non+Disponibile"
-            else:
-                image_url = str(image_raw).split(',')[0].strip()
-
-            # MAPPATURA COLONNE KAGGLE -> MODELLO INTERNO
-            product_dict = {
-                "Sku": str(row.get('id', row.get('asins', f'ID-{i}'))),
-                "Brand": str(row.get('brand', 'Generic')),
-                "Category": str(row.get('categories', 'Electronics')).split(',')[0],
-                "Product": str(row.get('name', 'Product Name N/A')),
-                "ImageUrl": image_url,
-                "Price": price,
-                "ShippingCost": 0.0,
-                "TotalCost": price,
-                "MinPrice": round(price * random.uniform(0.85, 0.98), 2),
-                "MinPriceWithShippingCost": round(price * random.uniform(0.85, 0.98), 2),
-                "Rank": random.randint(1, 8),
-                "RankWithShippingCost": random.randint(1, 8),
-                "NbMerchants": random.randint(1, 12),
-                "NbOffers": random.randint(1, 15),
-                "Popularity": random.randint(1, 100),
-                "BestOffers": [
-                    {"Price": round(price * 0.92, 2), "Merchant": "Amazon", "Rating": 4.8},
-                    {"Price": round(price * 0.96, 2), "Merchant": "BestBuy", "Rating": 4.5},
-                    {"Price": price, "Merchant": "Sensation Shop", "Rating": 4.9}
-                ]
-            }
-            products_list.append(product_dict)
+        # Estrazione Prezzo (scartiamo le righe senza prezzo valido)
+        if 'prices.amountMax' not in df:
+            return []
+        prices = pd.to_numeric(df['prices.amountMax'], errors='coerce')
+        valid = prices.notna() & (prices != 0)
+        df, price = df[valid], prices[valid].to_numpy(dtype=float)
+        n = len(df)
+
+        # Gestione Immagine (placeholder se la cella è vuota o NaN)
+        image_url = _text_column(df, 'imageURLs', '').str.split(',').str[0].str.strip()
+        image_url = image_url.where(image_url != '', PLACEHOLDER_IMAGE_URL)
+
+        # SKU: id, altrimenti ASIN, altrimenti un ID posizionale
+        sku = _text_column(df, 'asins', '')
+        sku = sku.where(sku != '', 'ID-' + df.index.astype(str))
+        if 'id' in df:
+            sku = df['id'].astype(object).where(df['id'].notna(), sku).astype(str)
+
+        # MAPPATURA COLONNE KAGGLE -> MODELLO INTERNO (dati di mercato simulati in blocco)
+        rng = np.random.default_rng()
+        # Spedizione sempre 0: il minimo di mercato con e senza spedizione coincide
+        min_price = np.round(price * rng.uniform(0.85, 0.98, n), 2)
+        products_list = pd.DataFrame({
+            "Sku": sku,
+            "Brand": _text_column(df, 'brand', 'Generic'),
+            "Category": _text_column(df, 'categories', 'Electronics').str.split(',').str[0],
+            "Product": _text_column(df, 'name', 'Product Name N/A'),
+            "ImageUrl": image_url,
+            "Price": price,
+            "ShippingCost": 0.0,
+            "TotalCost": price,
+            "MinPrice": min_price,
+            "MinPriceWithShippingCost": min_price,
+            "Rank": rng.integers(1, 9, n),
+            "RankWithShippingCost": rng.integers(1, 9, n),
+            "NbMerchants": rng.integers(1, 13, n),
+            "NbOffers": rng.integers(1, 16, n),
+            "Popularity": rng.integers(1, 101, n),
+        }).to_dict(orient="records")
+
+        amazon_prices = np.round(price * 0.92, 2).tolist()
+        bestbuy_prices = np.round(price * 0.96, 2).tolist()
+        for product, my_price, amazon_price, bestbuy_price in zip(products_list, price.tolist(), amazon_prices, bestbuy_prices):
+            product["BestOffers"] = [
+                {"Price": amazon_price, "Merchant": "Amazon", "Rating": 4.8},
+                {"Price": bestbuy_price, "Merchant": "BestBuy", "Rating": 4.5},
+                {"Price": my_price, "Merchant": "Sensation Shop", "Rating": 4.9}
+            ]
             
         return products_list
     except Exception as e:
-        logger.error(f"Errore GSheet: {e}")
+        logger.error("Errore GSheet: %s", e)
         return []
 
 def get_mock_data():